@@ -1,17 +1,21 @@
 import asyncio
-import io
+import bisect
 import logging
 import os
+import shutil
 import tempfile
-from typing import List, Tuple, Optional
+import time
+from typing import Dict, List, Set, Tuple, Optional, Union
 from dataclasses import dataclass
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import BufferedInputFile, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import FSInputFile, ReplyKeyboardMarkup, KeyboardButton
 try:
     from aiogram import BaseMiddleware
 except ImportError:
@@ -21,7 +25,12 @@ except ImportError:
     except ImportError:
         # Альтернативный импорт для разных версий
         from aiogram.dispatcher.middlewares import BaseMiddleware
-from PIL import Image
+try:
+    import uvloop
+except ImportError:
+    # uvloop недоступен (например, на Windows) - используем стандартный event loop
+    uvloop = None
+from PIL import Image, ImageOps
 
 # =============================================================================
 # КОНФИГУРАЦИЯ И КОНСТАНТЫ
@@ -32,8 +41,12 @@ class Config:
     """Конфигурация приложения"""
     MAX_FILE_SIZE: int = 20 * 1024 * 1024  # 20MB
     MAX_IMAGE_DIMENSION: int = 4096  # Максимальный размер изображения
+    MAX_OUTPUT_DIMENSION: int = 2048  # Максимальный размер результата в JPEG и PDF
     SUPPORTED_FORMATS: List[str] = None
     KEYBOARD_ROW_SIZE: int = 3
+    PROGRESS_UPDATE_INTERVAL: float = 0.5  # Минимальный интервал между обновлениями прогресса, сек
+    HTTP_KEEPALIVE_TIMEOUT: int = 60  # Время жизни keep-alive соединения, сек
+    SHUTDOWN_TIMEOUT: float = 25.0  # Ожидание активных конвертаций при остановке, сек
     ICO_SIZES: List[int] = None
     
     def __post_init__(self):
@@ -47,6 +60,19 @@ class Config:
 
 config = Config()
 
+# Производные константы, вычисляемые один раз
+MAX_FILE_SIZE_MB = config.MAX_FILE_SIZE // (1024 * 1024)
+LANCZOS = Image.Resampling.LANCZOS
+
+# Пул потоков для CPU-bound операций PIL (кодирование не должно блокировать event loop)
+EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# Директория для исходных файлов пользователей между шагами FSM
+TEMP_DIR = tempfile.mkdtemp(prefix="convertbot_")
+
+# Активные конвертации: при остановке бота дожидаемся их завершения
+ACTIVE_CONVERSIONS: Set[asyncio.Task] = set()
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -74,16 +100,17 @@ class LoggingMiddleware(BaseMiddleware):
     """Middleware для логирования запросов"""
     
     async def __call__(self, handler, event, data):
-        if hasattr(event, 'from_user') and event.from_user:
+        # Проверяем уровень заранее и форматируем лениво: middleware вызывается на каждое сообщение
+        if logger.isEnabledFor(logging.INFO) and isinstance(event, types.Message) and event.from_user:
             user_id = event.from_user.id
             username = event.from_user.username or "unknown"
-            logger.info(f"Request from user {user_id} (@{username})")
+            logger.info("Request from user %s (@%s)", user_id, username)
         
         try:
             return await handler(event, data)
         except Exception as e:
-            logger.error(f"Error in handler: {e}", exc_info=True)
-            if hasattr(event, 'reply'):
+            logger.error("Error in handler: %s", e, exc_info=True)
+            if isinstance(event, types.Message):
                 try:
                     await event.reply("⛔ Произошла ошибка при обработке запроса. Попробуйте позже.")
                 except Exception:
@@ -94,19 +121,20 @@ class FileSizeMiddleware(BaseMiddleware):
     """Middleware для проверки размера файлов"""
     
     async def __call__(self, handler, event, data):
-        if hasattr(event, 'photo') and event.photo:
-            photo = event.photo[-1]  # Берем самое большое фото
-            if photo.file_size and photo.file_size > config.MAX_FILE_SIZE:
-                await event.reply(
-                    f"⛔ Файл слишком большой. Максимальный размер: {config.MAX_FILE_SIZE // (1024*1024)} МБ"
-                )
-                return
-        elif hasattr(event, 'document') and event.document:
-            if event.document.file_size and event.document.file_size > config.MAX_FILE_SIZE:
-                await event.reply(
-                    f"⛔ Файл слишком большой. Максимальный размер: {config.MAX_FILE_SIZE // (1024*1024)} МБ"
-                )
-                return
+        if isinstance(event, types.Message):
+            if event.photo:
+                photo = event.photo[-1]  # Берем самое большое фото
+                if photo.file_size and photo.file_size > config.MAX_FILE_SIZE:
+                    await event.reply(
+                        f"⛔ Файл слишком большой. Максимальный размер: {MAX_FILE_SIZE_MB} МБ"
+                    )
+                    return
+            elif event.document:
+                if event.document.file_size and event.document.file_size > config.MAX_FILE_SIZE:
+                    await event.reply(
+                        f"⛔ Файл слишком большой. Максимальный размер: {MAX_FILE_SIZE_MB} МБ"
+                    )
+                    return
         
         return await handler(event, data)
 
@@ -154,184 +182,231 @@ class ImageConverter:
         'APNG': ('PNG', 'apng'),
     }
     
+    # Параметры сохранения: для интерактивного бота важнее скорость кодирования,
+    # чем несколько процентов размера файла
+    SAVE_KWARGS = {
+        'PNG': {'compress_level': 1},
+        'WEBP': {'quality': 85, 'method': 0},
+    }
+    
+    # Стандартные размеры ICO по возрастанию (для bisect)
+    ICO_STANDARD_SIZES = (32, 64, 128, 256)
+    
+    # Форматы без поддержки прозрачности: используют общий RGB-вариант
+    NO_ALPHA_FORMATS = frozenset({'JPEG', 'PDF'})
+    
+    # Форматы, в которых сохраняется анимация
+    ANIMATED_FORMATS = frozenset({'GIF', 'APNG', 'WEBP'})
+    
+    # Форматы исходника, в которых несколько кадров означают анимацию.
+    # В остальных это другие данные: второй снимок MPO, страницы TIFF
+    ANIMATED_SOURCE_FORMATS = frozenset({'GIF', 'PNG', 'WEBP'})
+    
+    # Источники, для которых не нужен декодированный кадр
+    SOURCE_ORIGINAL = 'original'  # Исходный файл уже в нужном формате
+    SOURCE_ANIMATED = 'animated'  # Все кадры пересохраняются из исходного файла
+    
+    @classmethod
+    def prepare_sources(cls, img: Image.Image, formats: List[str]) -> Dict[str, Union[Image.Image, str]]:
+        """
+        Подготовка исходных изображений для параллельной конвертации
+        
+        Изображение декодируется один раз, RGB-вариант для форматов без
+        прозрачности вычисляется один раз и уменьшается до
+        MAX_OUTPUT_DIMENSION. Форматы получают общие объекты,
+        копия снимается в _convert_sync. Для формата исходного файла и для
+        анимированных форматов вместо изображения возвращается
+        SOURCE_ORIGINAL или SOURCE_ANIMATED.
+        """
+        source_format = img.format
+        is_animated = source_format in cls.ANIMATED_SOURCE_FORMATS and getattr(img, 'is_animated', False)
+        
+        sources = {}
+        for fmt in formats:
+            if cls.FORMAT_MAP[fmt][0] == source_format:
+                sources[fmt] = cls.SOURCE_ORIGINAL
+            elif is_animated and fmt in cls.ANIMATED_FORMATS:
+                sources[fmt] = cls.SOURCE_ANIMATED
+        
+        pending = [fmt for fmt in formats if fmt not in sources]
+        if not pending:
+            return sources
+        
+        limit = config.MAX_OUTPUT_DIMENSION
+        flat_pending = cls.NO_ALPHA_FORMATS.intersection(pending)
+        
+        # Если нужны только JPEG/PDF, крупное изображение уменьшаем до декодирования:
+        # для JPEG thumbnail() использует draft(), и libjpeg сразу декодирует в уменьшенном масштабе
+        if flat_pending.issuperset(pending) and max(img.size) > limit:
+            img.thumbnail((limit, limit), LANCZOS)
+        
+        img.load()
+        
+        flat_img = None
+        if flat_pending:
+            flat_img = cls.flatten_alpha(img)
+            if max(flat_img.size) > limit:
+                flat_img = ImageOps.contain(flat_img, (limit, limit), LANCZOS)
+        
+        sources.update({
+            fmt: flat_img if fmt in cls.NO_ALPHA_FORMATS else img
+            for fmt in pending
+        })
+        return sources
+    
+    @staticmethod
+    def flatten_alpha(img: Image.Image) -> Image.Image:
+        """Наложение прозрачного изображения на белый фон"""
+        if img.mode not in ("RGBA", "LA", "P"):
+            return img
+        
+        # Альфа-канал берем через getchannel() без split() всех каналов.
+        # convert и paste выполняются в C-коде PIL с отпущенным GIL,
+        # поэтому смешивание идет параллельно в EXECUTOR
+        rgba = img.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        return background
+    
     @classmethod
-    async def convert_to_format(cls, img: Image.Image, format_name: str) -> Tuple[bool, io.BytesIO, str]:
+    async def convert_to_format(cls, img: Image.Image, format_name: str, output: str) -> Tuple[bool, str]:
         """
-        Конвертация изображения в указанный формат
+        Конвертация изображения в указанный формат с записью в файл output
         
         Returns:
-            Tuple[success, buffer, error_message]
+            Tuple[success, error_message]
         """
         try:
             if format_name not in cls.FORMAT_MAP:
-                return False, io.BytesIO(), f"Неподдерживаемый формат: {format_name}"
+                return False, f"Неподдерживаемый формат: {format_name}"
             
             pil_format, extension = cls.FORMAT_MAP[format_name]
-            output = io.BytesIO()
             
-            # Специальная обработка для разных форматов
-            if format_name == 'ICO':
-                converted_img = await cls._convert_to_ico(img, output)
-            elif format_name == 'JPEG':
-                converted_img = await cls._convert_to_jpeg(img, output, pil_format)
-            elif format_name == 'PDF':
-                converted_img = await cls._convert_to_pdf(img, output)
-            else:
-                img.save(output, format=pil_format, optimize=True)
-                converted_img = True
+            # Кодирование выполняем в пуле, чтобы не блокировать event loop
+            loop = asyncio.get_running_loop()
+            converted_img = await loop.run_in_executor(
+                EXECUTOR, cls._convert_sync, img, format_name, pil_format, output
+            )
             
             if not converted_img:
-                return False, io.BytesIO(), f"Не удалось конвертировать в {format_name}"
+                return False, f"Не удалось конвертировать в {format_name}"
             
-            output.seek(0)
-            return True, output, ""
+            return True, ""
             
         except Exception as e:
             logger.error(f"Ошибка конвертации в {format_name}: {e}")
-            return False, io.BytesIO(), f"Ошибка конвертации: {str(e)}"
+            return False, f"Ошибка конвертации: {str(e)}"
     
-    @staticmethod
-    async def _convert_to_ico(img: Image.Image, output: io.BytesIO) -> bool:
-        """Конвертация в ICO формат"""
+    @classmethod
+    async def convert_animated(cls, source_path: str, format_name: str, output: str) -> Tuple[bool, str]:
+        """
+        Конвертация анимированного изображения с сохранением всех кадров
+        
+        Returns:
+            Tuple[success, error_message]
+        """
         try:
-            # Получаем оригинальный размер
-            original_size = min(img.width, img.height)
-            
-            # Определяем подходящие размеры для ICO
-            # Используем только стандартные размеры, которые хорошо поддерживаются
-            if original_size >= 256:
-                sizes = [256]
-            elif original_size >= 128:
-                sizes = [128]
-            elif original_size >= 64:
-                sizes = [64]
-            elif original_size >= 32:
-                sizes = [32]
-            else:
-                # Для очень маленьких изображений используем оригинальный размер
-                sizes = [original_size] if original_size >= 16 else [16]
-            
-            # Создаем изображения разных размеров
-            images = []
+            pil_format, extension = cls.FORMAT_MAP[format_name]
             
-            for size in sizes:
-                # Изменяем размер с высоким качеством
-                if img.width != size or img.height != size:
-                    # Создаем квадратное изображение
-                    if img.width != img.height:
-                        # Если изображение не квадратное, обрезаем до квадрата
-                        min_dimension = min(img.width, img.height)
-                        left = (img.width - min_dimension) // 2
-                        top = (img.height - min_dimension) // 2
-                        right = left + min_dimension
-                        bottom = top + min_dimension
-                        square_img = img.crop((left, top, right, bottom))
-                    else:
-                        square_img = img
-                    
-                    resized = square_img.resize((size, size), Image.Resampling.LANCZOS)
-                else:
-                    resized = img.copy()
-                
-                # Правильная обработка цветовых режимов для ICO
-                if resized.mode == 'RGBA':
-                    # RGBA оставляем как есть
-                    pass
-                elif resized.mode == 'RGB':
-                    # RGB тоже оставляем, ICO поддерживает
-                    pass
-                elif resized.mode == 'P':
-                    # Палитровые изображения конвертируем в RGBA
-                    resized = resized.convert('RGBA')
-                elif resized.mode in ['L', 'LA']:
-                    # Градации серого конвертируем в RGBA
-                    resized = resized.convert('RGBA')
-                else:
-                    # Остальные режимы конвертируем в RGBA
-                    resized = resized.convert('RGBA')
-                
-                images.append(resized)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                EXECUTOR, cls._convert_animated_sync, source_path, pil_format, output
+            )
+            return True, ""
             
-            # Сохраняем ICO файл
-            if images:
-                # Создаем кортеж размеров
-                sizes_tuple = [(img.width, img.height) for img in images]
-                
-                # Сохраняем первое изображение как основное
-                first_image = images[0]
-                
-                # Используем более простые параметры для совместимости
-                save_kwargs = {
-                    'format': 'ICO',
-                    'sizes': sizes_tuple,
-                    'bitmap_format': 'bmp'
-                }
-                
-                # Добавляем дополнительные изображения только если они есть
-                if len(images) > 1:
-                    save_kwargs['append_images'] = images[1:]
-                
-                first_image.save(output, **save_kwargs)
-                
-                output.seek(0)
-                logger.info(f"ICO файл успешно создан, размеры: {sizes_tuple}")
-                return True
-            else:
-                return False
-                
+        except Exception as e:
+            logger.error(f"Ошибка конвертации анимации в {format_name}: {e}")
+            return False, f"Ошибка конвертации: {str(e)}"
+    
+    @classmethod
+    def _convert_animated_sync(cls, source_path: str, pil_format: str, output: str) -> None:
+        """Синхронная конвертация анимации (выполняется в EXECUTOR)"""
+        # Каждая задача открывает свой экземпляр файла: кадры читаются
+        # последовательно, и общий объект нельзя использовать из разных потоков
+        with Image.open(source_path) as src:
+            src.save(output, format=pil_format, save_all=True, **cls.SAVE_KWARGS.get(pil_format, {}))
+    
+    @classmethod
+    def _convert_sync(cls, img: Image.Image, format_name: str, pil_format: str, output: str) -> bool:
+        """Синхронная конвертация (выполняется в EXECUTOR)"""
+        # Специальная обработка для разных форматов
+        if format_name == 'ICO':
+            return cls._convert_to_ico(img, output)
+        
+        # Исходник общий для всех форматов, а PIL записывает параметры
+        # кодирования в сам объект при save(). Копию снимаем здесь, а не
+        # заранее: одновременно в памяти не больше копий, чем потоков в EXECUTOR
+        img = img.copy()
+        
+        if format_name == 'JPEG':
+            return cls._convert_to_jpeg(img, output, pil_format)
+        elif format_name == 'PDF':
+            return cls._convert_to_pdf(img, output)
+        
+        img.save(output, format=pil_format, **cls.SAVE_KWARGS.get(pil_format, {}))
+        return True
+    
+    @staticmethod
+    def _prepare_ico_image(img: Image.Image) -> Image.Image:
+        """Подготовка квадратного изображения стандартного размера для ICO"""
+        original_size = min(img.width, img.height)
+        
+        # Используем наибольший стандартный размер, не превышающий исходный
+        idx = bisect.bisect_right(ImageConverter.ICO_STANDARD_SIZES, original_size) - 1
+        if idx >= 0:
+            size = ImageConverter.ICO_STANDARD_SIZES[idx]
+        else:
+            # Для очень маленьких изображений используем оригинальный размер
+            size = max(original_size, 16)
+        
+        # ICO поддерживает RGB и RGBA, остальные режимы конвертируем в RGBA
+        # до изменения размера: resize не работает с режимами вроде I;16,
+        # а палитровые изображения иначе масштабируются только NEAREST
+        icon = img
+        if icon.mode not in ('RGB', 'RGBA'):
+            icon = icon.convert('RGBA')
+        
+        # Обрезаем по центру до квадрата и изменяем размер одним вызовом.
+        # ImageOps.fit и convert возвращают новое изображение; если ни то,
+        # ни другое не понадобилось, копируем сами: исходник общий для всех форматов
+        if icon.size != (size, size):
+            icon = ImageOps.fit(icon, (size, size), LANCZOS)
+        elif icon is img:
+            icon = img.copy()
+        
+        return icon
+    
+    @staticmethod
+    def _convert_to_ico(img: Image.Image, output: str) -> bool:
+        """Конвертация в ICO формат"""
+        try:
+            icon = ImageConverter._prepare_ico_image(img)
+        except Exception as e:
+            logger.error(f"Ошибка подготовки изображения для ICO: {e}")
+            return False
+        
+        sizes = [icon.size]
+        try:
+            icon.save(output, format='ICO', sizes=sizes, bitmap_format='bmp')
         except Exception as e:
             logger.error(f"Ошибка конвертации в ICO: {e}")
             
-            # Попробуем упрощенный метод как fallback
+            # Повторяем с параметрами по умолчанию, не пересчитывая изображение
             try:
-                # Простой метод - один размер, без сложных преобразований
-                simple_size = min(256, min(img.width, img.height))
-                
-                # Обрезаем до квадрата если нужно
-                if img.width != img.height:
-                    min_dimension = min(img.width, img.height)
-                    left = (img.width - min_dimension) // 2
-                    top = (img.height - min_dimension) // 2
-                    right = left + min_dimension
-                    bottom = top + min_dimension
-                    square_img = img.crop((left, top, right, bottom))
-                else:
-                    square_img = img
-                
-                # Изменяем размер
-                if square_img.size != (simple_size, simple_size):
-                    resized = square_img.resize((simple_size, simple_size), Image.Resampling.LANCZOS)
-                else:
-                    resized = square_img
-                
-                # Конвертируем в подходящий режим
-                if resized.mode not in ['RGB', 'RGBA']:
-                    if 'transparency' in resized.info or resized.mode in ['LA', 'P']:
-                        resized = resized.convert('RGBA')
-                    else:
-                        resized = resized.convert('RGB')
-                
-                # Сохраняем с минимальными параметрами
-                resized.save(output, format='ICO', bitmap_format='bmp')
-                output.seek(0)
-                return True
-                
+                icon.save(output, format='ICO')
             except Exception as fallback_error:
                 logger.error(f"Fallback ICO конвертация тоже не удалась: {fallback_error}")
                 return False
+        
+        logger.info(f"ICO файл успешно создан, размеры: {sizes}")
+        return True
     
     @staticmethod
-    async def _convert_to_jpeg(img: Image.Image, output: io.BytesIO, pil_format: str) -> bool:
+    def _convert_to_jpeg(img: Image.Image, output: str, pil_format: str) -> bool:
         """Конвертация в JPEG формат"""
         try:
             # JPEG не поддерживает прозрачность
-            if img.mode in ("RGBA", "LA", "P"):
-                # Создаем белый фон
-                background = Image.new("RGB", img.size, (255, 255, 255))
-                if img.mode == "P":
-                    img = img.convert("RGBA")
-                background.paste(img, mask=img.split()[-1] if img.mode == "RGBA" else None)
-                img = background
+            img = ImageConverter.flatten_alpha(img)
             
             img.save(output, format=pil_format, optimize=True, quality=90)
             return True
@@ -340,9 +415,10 @@ class ImageConverter:
             return False
     
     @staticmethod
-    async def _convert_to_pdf(img: Image.Image, output: io.BytesIO) -> bool:
+    def _convert_to_pdf(img: Image.Image, output: str) -> bool:
         """Конвертация в PDF формат"""
         try:
+            img = ImageConverter.flatten_alpha(img)
             if img.mode != "RGB":
                 img = img.convert("RGB")
             img.save(output, format='PDF', optimize=True)
@@ -372,6 +448,10 @@ class KeyboardBuilder:
         
         return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True, one_time_keyboard=False)
 
+# Список форматов не меняется во время работы: строим клавиатуру и множество один раз
+SUPPORTED_FORMATS_SET = frozenset(config.SUPPORTED_FORMATS)
+FORMATS_KEYBOARD = KeyboardBuilder.create_formats_keyboard(config.SUPPORTED_FORMATS)
+
 # =============================================================================
 # ОБРАБОТЧИКИ
 # =============================================================================
@@ -407,23 +487,40 @@ async def help_handler(message: types.Message):
         "• JPEG2000 - улучшенное сжатие\n"
         "• APNG - анимированный PNG\n\n"
         "⚠️ <b>Ограничения:</b>\n"
-        f"• Максимальный размер файла: {config.MAX_FILE_SIZE // (1024*1024)} МБ\n"
+        f"• Максимальный размер файла: {MAX_FILE_SIZE_MB} МБ\n"
         f"• Максимальное разрешение: {config.MAX_IMAGE_DIMENSION}x{config.MAX_IMAGE_DIMENSION}"
     )
     await message.reply(help_text, parse_mode='HTML')
 
+def remove_temp_file(path: Optional[str]) -> None:
+    """Удаление временного файла, если он существует"""
+    if not path:
+        return
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
 @asynccontextmanager
-async def safe_file_download(bot: Bot, file_path: str):
-    """Безопасное скачивание файла во временную директорию"""
-    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
+async def safe_file_download(bot: Bot, file_path: str, keep: bool = False):
+    """
+    Безопасное скачивание файла во временную директорию
+    
+    При keep=True файл не удаляется после выхода из контекста,
+    ответственность за его удаление переходит к вызывающему коду.
+    При ошибке файл удаляется всегда.
+    """
+    with tempfile.NamedTemporaryFile(delete=False, dir=TEMP_DIR) as tmp_file:
         try:
+            # Передаем путь, а не открытый дескриптор: по пути aiogram пишет через
+            # aiofiles, а в файловый объект - синхронно в event loop на каждый чанк
             await bot.download_file(file_path, tmp_file.name)
             yield tmp_file.name
-        finally:
-            try:
-                os.unlink(tmp_file.name)
-            except OSError:
-                pass
+        except BaseException:
+            remove_temp_file(tmp_file.name)
+            raise
+        if not keep:
+            remove_temp_file(tmp_file.name)
 
 async def photo_handler(message: types.Message, state: FSMContext, bot: Bot):
     """Обработчик изображений"""
@@ -444,44 +541,45 @@ async def photo_handler(message: types.Message, state: FSMContext, bot: Bot):
         # Получаем информацию о файле
         file_info = await bot.get_file(file_obj.file_id)
         
-        # Безопасно скачиваем и обрабатываем файл
-        async with safe_file_download(bot, file_info.file_path) as temp_file_path:
+        # Безопасно скачиваем и обрабатываем файл. Файл остается на диске
+        # до конвертации, в состоянии хранится только путь к нему
+        async with safe_file_download(bot, file_info.file_path, keep=True) as temp_file_path:
             try:
                 # Открываем изображение
-                img = Image.open(temp_file_path)
-                original_format = img.format or 'UNKNOWN'
-                
-                # Валидация изображения
-                is_valid, error_msg = ImageValidator.validate_image(img)
-                if not is_valid:
-                    await processing_msg.edit_text(f"⛔ {error_msg}")
-                    return
-                
-                # Читаем файл в байты для сохранения в состоянии
-                with open(temp_file_path, 'rb') as f:
-                    file_bytes = f.read()
-                
-                # Сохраняем данные в состоянии
-                await state.update_data(
-                    photo_bytes=file_bytes,
-                    original_format=original_format,
-                    selected_formats=[],
-                    image_info={
-                        'width': img.width,
-                        'height': img.height,
-                        'mode': img.mode,
-                        'size_kb': len(file_bytes) // 1024
-                    }
-                )
+                with Image.open(temp_file_path) as img:
+                    original_format = img.format or 'UNKNOWN'
+                    
+                    # Валидация изображения
+                    is_valid, error_msg = ImageValidator.validate_image(img)
+                    if not is_valid:
+                        remove_temp_file(temp_file_path)
+                        await processing_msg.edit_text(f"⛔ {error_msg}")
+                        return
+                    
+                    # Сохраняем данные в состоянии. Путь предыдущего исходника читаем
+                    # вплотную к записи нового, без await между ними: при параллельной
+                    # обработке нескольких загрузок (альбом) каждый обработчик удаляет
+                    # именно тот файл, который заменил
+                    previous_path = (await state.get_data()).get("photo_path")
+                    await state.update_data(
+                        photo_path=temp_file_path,
+                        original_format=original_format,
+                        selected_formats=[],
+                        image_info={
+                            'width': img.width,
+                            'height': img.height,
+                            'mode': img.mode,
+                            'size_kb': os.path.getsize(temp_file_path) // 1024
+                        }
+                    )
+                    remove_temp_file(previous_path)
                 
             except Exception as e:
                 logger.error(f"Ошибка при обработке изображения: {e}")
+                remove_temp_file(temp_file_path)
                 await processing_msg.edit_text("⛔ Не удалось обработать изображение. Убедитесь, что это корректный файл изображения.")
                 return
         
-        # Создаем клавиатуру с форматами
-        keyboard = KeyboardBuilder.create_formats_keyboard(config.SUPPORTED_FORMATS)
-        
         # Устанавливаем состояние ожидания выбора форматов
         await state.set_state(ConversionStates.waiting_for_formats)
         
@@ -497,7 +595,7 @@ async def photo_handler(message: types.Message, state: FSMContext, bot: Bot):
         )
         
         await processing_msg.edit_text(info_text, parse_mode='HTML')
-        await message.reply("Выбери формат из меню ниже:", reply_markup=keyboard)
+        await message.reply("Выбери формат из меню ниже:", reply_markup=FORMATS_KEYBOARD)
         
     except Exception as e:
         logger.error(f"Ошибка в photo_handler: {e}")
@@ -514,7 +612,7 @@ async def formats_handler(message: types.Message, state: FSMContext, bot: Bot):
             return
         
         # Проверяем, поддерживается ли формат
-        if text not in config.SUPPORTED_FORMATS:
+        if text not in SUPPORTED_FORMATS_SET:
             supported_list = ', '.join(config.SUPPORTED_FORMATS)
             await message.reply(f"⛔ Неподдерживаемый формат.\n\n✅ Поддерживаемые форматы:\n{supported_list}")
             return
@@ -540,6 +638,58 @@ async def formats_handler(message: types.Message, state: FSMContext, bot: Bot):
         logger.error(f"Ошибка в formats_handler: {e}")
         await message.reply("⛔ Произошла ошибка при обработке выбора формата.")
 
+async def send_converted_file(message: types.Message, path: str, fmt: str) -> Tuple[bool, str]:
+    """
+    Отправка файла с результатом конвертации
+    
+    Returns:
+        Tuple[success, error_message]
+    """
+    try:
+        extension = ImageConverter.FORMAT_MAP[fmt][1]
+        filename = f"converted.{extension}"
+        
+        await message.reply_document(
+            FSInputFile(path, filename=filename),
+            caption=f"✅ Конвертация в {fmt} завершена"
+        )
+        return True, ""
+        
+    except Exception as e:
+        logger.error(f"Ошибка при отправке файла {fmt}: {e}")
+        return False, "ошибка отправки"
+
+async def convert_and_send(
+    source: Union[Image.Image, str], fmt: str, message: types.Message, source_path: str
+) -> Tuple[bool, str]:
+    """
+    Конвертация изображения в один формат и отправка результата
+    
+    Returns:
+        Tuple[success, error_message]
+    """
+    # Исходный файл уже в нужном формате: отправляем его без перекодирования
+    if isinstance(source, str) and source == ImageConverter.SOURCE_ORIGINAL:
+        return await send_converted_file(message, source_path, fmt)
+    
+    # Результат пишем во временный файл и отправляем потоково с диска
+    fd, output_path = tempfile.mkstemp(dir=TEMP_DIR)
+    os.close(fd)
+    
+    try:
+        if isinstance(source, str) and source == ImageConverter.SOURCE_ANIMATED:
+            success, error_msg = await ImageConverter.convert_animated(source_path, fmt, output_path)
+        else:
+            success, error_msg = await ImageConverter.convert_to_format(source, fmt, output_path)
+        
+        if not success:
+            logger.error(f"Ошибка конвертации в {fmt}: {error_msg}")
+            return False, error_msg
+        
+        return await send_converted_file(message, output_path, fmt)
+    finally:
+        remove_temp_file(output_path)
+
 async def handle_conversion_completion(message: types.Message, state: FSMContext, data: dict):
     """Обработка завершения выбора форматов и конвертации"""
     selected_formats = data.get("selected_formats", [])
@@ -548,55 +698,80 @@ async def handle_conversion_completion(message: types.Message, state: FSMContext
         await message.reply("⛔ Ты не выбрал ни одного формата для конвертации.")
         return
     
-    photo_bytes = data.get("photo_bytes")
-    if not photo_bytes:
+    # Забираем исходник себе до первого await: новое изображение или повторное
+    # нажатие "ГОТОВО" во время конвертации уже не увидят этот файл в состоянии
+    photo_path = data.get("photo_path")
+    await state.clear()
+    
+    if not photo_path or not os.path.exists(photo_path):
         await message.reply("⛔ Данные изображения потеряны. Отправь изображение заново.")
-        await state.clear()
         return
     
     # Сообщение о начале конвертации
-    conversion_msg = await message.reply(
-        f"🔄 Начинаю конвертацию в {len(selected_formats)} формат(ов)...",
-        reply_markup=types.ReplyKeyboardRemove()
-    )
+    try:
+        conversion_msg = await message.reply(
+            f"🔄 Начинаю конвертацию в {len(selected_formats)} формат(ов)...",
+            reply_markup=types.ReplyKeyboardRemove()
+        )
+    except Exception:
+        remove_temp_file(photo_path)
+        raise
+    
+    current_task = asyncio.current_task()
+    ACTIVE_CONVERSIONS.add(current_task)
+    tasks = []
     
     try:
-        img = Image.open(io.BytesIO(photo_bytes))
-        successful_conversions = 0
-        failed_conversions = []
+        # Декодируем изображение один раз и готовим исходники для каждого формата
+        loop = asyncio.get_running_loop()
+        with Image.open(photo_path) as img:
+            sources = await loop.run_in_executor(
+                EXECUTOR, ImageConverter.prepare_sources, img, selected_formats
+            )
         
-        for i, fmt in enumerate(selected_formats, 1):
-            # Обновляем прогресс (безопасно)
+        # Запускаем конвертацию и отправку всех форматов одновременно
+        tasks = [
+            asyncio.create_task(convert_and_send(sources[fmt], fmt, message, photo_path))
+            for fmt in selected_formats
+        ]
+        
+        # Прогресс обновляем по мере готовности форматов, но не чаще
+        # PROGRESS_UPDATE_INTERVAL: каждое редактирование - запрос к Telegram
+        completed = 0
+        last_edit_ts = time.monotonic()
+        for next_done in asyncio.as_completed(tasks):
             try:
-                await conversion_msg.edit_text(
-                    f"🔄 Конвертирую в {fmt}... ({i}/{len(selected_formats)})"
-                )
+                await next_done
             except Exception:
-                # Если не можем редактировать, отправляем новое сообщение
-                conversion_msg = await message.reply(
-                    f"🔄 Конвертирую в {fmt}... ({i}/{len(selected_formats)})"
-                )
-            
-            # Конвертируем изображение
-            success, output_buffer, error_msg = await ImageConverter.convert_to_format(img, fmt)
+                # Ошибки обрабатываются ниже вместе с результатами
+                pass
+            completed += 1
             
-            if success:
+            if completed < len(tasks) and time.monotonic() - last_edit_ts > config.PROGRESS_UPDATE_INTERVAL:
                 try:
-                    extension = ImageConverter.FORMAT_MAP[fmt][1]
-                    filename = f"converted.{extension}"
-                    
-                    await message.reply_document(
-                        BufferedInputFile(output_buffer.getvalue(), filename=filename),
-                        caption=f"✅ Конвертация в {fmt} завершена"
+                    await conversion_msg.edit_text(
+                        f"🔄 Конвертирую... ({completed}/{len(tasks)})"
                     )
-                    successful_conversions += 1
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке файла {fmt}: {e}")
-                    failed_conversions.append(f"{fmt}: ошибка отправки")
+                except Exception:
+                    pass
+                last_edit_ts = time.monotonic()
+        
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        
+        successful_conversions = 0
+        failed_conversions = []
+        
+        for fmt, result in zip(selected_formats, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка конвертации в {fmt}: {result}")
+                failed_conversions.append(f"{fmt}: {result}")
+                continue
+            
+            success, error_msg = result
+            if success:
+                successful_conversions += 1
             else:
                 failed_conversions.append(f"{fmt}: {error_msg}")
-                logger.error(f"Ошибка конвертации в {fmt}: {error_msg}")
         
         # Финальное сообщение
         result_text = f"🎉 Конвертация завершена!\n\n"
@@ -627,12 +802,22 @@ async def handle_conversion_completion(message: types.Message, state: FSMContext
                 "Проверьте изображение и попробуйте снова."
             )
     finally:
-        await state.clear()
+        # При отмене (остановка бота) дочерние задачи не отменяются сами:
+        # останавливаем их, пока они еще читают исходный файл
+        unfinished = [task for task in tasks if not task.done()]
+        for task in unfinished:
+            task.cancel()
+        if unfinished:
+            await asyncio.gather(*unfinished, return_exceptions=True)
+        
+        ACTIVE_CONVERSIONS.discard(current_task)
+        remove_temp_file(photo_path)
 
 async def cancel_handler(message: types.Message, state: FSMContext):
     """Обработчик отмены операции"""
     current_state = await state.get_state()
     if current_state is not None:
+        remove_temp_file((await state.get_data()).get("photo_path"))
         await state.clear()
         await message.reply(
             "⛔ Операция отменена. Отправь новое изображение для конвертации.",
@@ -641,6 +826,26 @@ async def cancel_handler(message: types.Message, state: FSMContext):
     else:
         await message.reply("🤔 Нет активных операций для отмены.")
 
+async def on_shutdown():
+    """Завершение активных конвертаций и очистка временных файлов при остановке бота"""
+    # Polling уже остановлен, но сессия бота еще открыта: даем текущим
+    # конвертациям догрузить результаты
+    if ACTIVE_CONVERSIONS:
+        logger.info(f"Ожидаю завершения конвертаций: {len(ACTIVE_CONVERSIONS)}")
+        _, pending = await asyncio.wait(set(ACTIVE_CONVERSIONS), timeout=config.SHUTDOWN_TIMEOUT)
+        
+        # Не успевшие конвертации отменяем и дожидаемся, пока они освободят
+        # временные файлы, и только потом удаляем директорию
+        if pending:
+            logger.info(f"Отменяю незавершенные конвертации: {len(pending)}")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+    
+    # shutdown(wait=True) блокирует поток до завершения текущих задач пула
+    await asyncio.to_thread(EXECUTOR.shutdown, wait=True, cancel_futures=True)
+    shutil.rmtree(TEMP_DIR, ignore_errors=True)
+
 # =============================================================================
 # ОСНОВНАЯ ФУНКЦИЯ
 # =============================================================================
@@ -648,8 +853,16 @@ async def cancel_handler(message: types.Message, state: FSMContext):
 async def main():
     """Основная функция запуска бота"""
     try:
+        # Держим соединения к Telegram API дольше, чтобы параллельная отправка
+        # файлов шла по уже открытым. Лимиты пула оставляем по умолчанию
+        # (limit=100 без лимита на хост): все запросы идут на один хост
+        session = AiohttpSession()
+        session._connector_init.update(
+            keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT,
+        )
+        
         # Создаем бота и диспетчер
-        bot = Bot(token=BOT_TOKEN)
+        bot = Bot(token=BOT_TOKEN, session=session)
         dp = Dispatcher()
         
         # Добавляем middleware
@@ -671,14 +884,21 @@ async def main():
         # Регистрируем обработчик выбора форматов
         dp.message.register(formats_handler, ConversionStates.waiting_for_formats)
         
+        # Очищаем временные файлы при остановке
+        dp.shutdown.register(on_shutdown)
+        
         logger.info("🚀 Запускаю бота...")
-        await dp.start_polling(bot)
+        # start_polling сам обрабатывает SIGINT/SIGTERM и затем вызывает on_shutdown
+        await dp.start_polling(bot, handle_signals=True)
         
     except Exception as e:
         logger.error(f"Критическая ошибка при запуске бота: {e}")
         raise
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    
     try:
         asyncio.run(main())
     except KeyboardInterrupt: